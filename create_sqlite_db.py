@@ -3,20 +3,139 @@
 Convert Claude Code usage JSON data to SQLite database for Grafana.
 
 Features:
-- Validates JSON structure before processing
+- Validates JSON structure while loading (invalid input changes nothing)
+- Parses exports with orjson, or streams them with ijson, when installed
 - Supports incremental updates (append vs replace)
 - Generates summary statistics
 - Handles timezone-aware dates
 - Comprehensive error handling
 """
 
+import hashlib
 import json
+import re
 import sqlite3
 import os
 import sys
-from datetime import datetime
+from contextlib import nullcontext
+from datetime import date
+from functools import lru_cache
+from itertools import chain
+from operator import itemgetter
 from pathlib import Path
 
+try:
+    import ijson
+except ImportError:  # optional: streams stdin, or files without orjson
+    ijson = None
+
+try:
+    import orjson
+except ImportError:  # optional: faster drop-in for json.loads
+    orjson = None
+
+
+# Fields every daily entry must carry
+REQUIRED_ENTRY_FIELDS = (
+    "date",
+    "totalTokens",
+    "totalCost",
+    "inputTokens",
+    "outputTokens",
+)
+
+# Fields every entry in a day's modelBreakdowns must carry
+REQUIRED_MODEL_FIELDS = ("modelName", "cost")
+
+# daily_usage columns in INSERT order, as daily entry fields
+DAILY_FIELDS = (
+    "date",
+    "inputTokens",
+    "outputTokens",
+    "cacheCreationTokens",
+    "cacheReadTokens",
+    "totalTokens",
+    "totalCost",
+)
+# Daily entry fields that default to 0 when missing
+OPTIONAL_DAILY_FIELDS = ("cacheCreationTokens", "cacheReadTokens")
+# Picks a daily_usage parameter tuple out of a daily entry
+daily_row = itemgetter(*DAILY_FIELDS)
+
+# Dates in ccusage exports are YYYY-MM-DD
+DATE_RE = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+
+# Daily entries parsed and inserted per batch while streaming the export
+DAYS_PER_BATCH = 1000
+
+# Rows per multi-row INSERT, further capped by SQLite's bound-parameter limit
+MAX_ROWS_PER_INSERT = 100
+# SQLITE_MAX_VARIABLE_NUMBER for SQLite builds older than 3.32
+SQLITE_DEFAULT_MAX_VARIABLES = 999
+
+# Secondary indexes, (re)built after the data is loaded. Lookups and
+# ORDER BY on date (either direction) use the UNIQUE(date) and
+# UNIQUE(date, model_name) indexes, so no separate date index is needed.
+INDEXES = (
+    (
+        "idx_model_name",
+        "CREATE INDEX IF NOT EXISTS idx_model_name ON model_usage(model_name)",
+    ),
+)
+
+# Indexes created by older versions that duplicate the UNIQUE indexes;
+# dropped so they no longer cost space and a B-tree insert per row
+REDUNDANT_INDEXES = ("idx_daily_date", "idx_model_date", "idx_model_date_name")
+
+DAILY_MODELS_VIEW_SQL = """
+    CREATE VIEW IF NOT EXISTS daily_models AS
+    SELECT date, GROUP_CONCAT(model_name) AS models_used
+    FROM model_usage
+    GROUP BY date
+"""
+
+# Plain INSERTs for replace mode, where the tables start out empty and
+# there is nothing to conflict with; upserts for append mode
+DAILY_INSERT_SQL = """
+    INSERT INTO daily_usage
+    (date, input_tokens, output_tokens, cache_creation_tokens,
+     cache_read_tokens, total_tokens, total_cost)
+    VALUES {values}
+"""
+
+DAILY_UPSERT_SQL = (
+    DAILY_INSERT_SQL
+    + """
+    ON CONFLICT(date) DO UPDATE SET
+        input_tokens=excluded.input_tokens,
+        output_tokens=excluded.output_tokens,
+        cache_creation_tokens=excluded.cache_creation_tokens,
+        cache_read_tokens=excluded.cache_read_tokens,
+        total_tokens=excluded.total_tokens,
+        total_cost=excluded.total_cost,
+        updated_at=CURRENT_TIMESTAMP
+"""
+)
+
+MODEL_INSERT_SQL = """
+    INSERT INTO model_usage
+    (date, model_name, input_tokens, output_tokens,
+     cache_creation_tokens, cache_read_tokens, cost)
+    VALUES {values}
+"""
+
+MODEL_UPSERT_SQL = (
+    MODEL_INSERT_SQL
+    + """
+    ON CONFLICT(date, model_name) DO UPDATE SET
+        input_tokens=excluded.input_tokens,
+        output_tokens=excluded.output_tokens,
+        cache_creation_tokens=excluded.cache_creation_tokens,
+        cache_read_tokens=excluded.cache_read_tokens,
+        cost=excluded.cost
+"""
+)
+
 
 def log_info(msg):
     """Print info message with icon"""
@@ -33,6 +152,14 @@ def log_error(msg):
     print(f"❌ {msg}", file=sys.stderr)
 
 
+def log_errors(msgs):
+    """Print several error messages with icons in a single write"""
+    # stderr is line-buffered, so one print per message is one write each
+    if msgs:
+        sys.stderr.write("".join(f"❌ {msg}\n" for msg in msgs))
+        sys.stderr.flush()
+
+
 def log_warn(msg):
     """Print warning message with icon"""
     print(f"⚠️  {msg}", file=sys.stderr)
@@ -40,7 +167,7 @@ def log_warn(msg):
 
 def validate_json_structure(data):
     """
-    Validate expected JSON structure from ccusage.
+    Validate the top-level JSON structure from ccusage.
 
     Args:
         data: Parsed JSON data
@@ -57,227 +184,665 @@ def validate_json_structure(data):
     if not isinstance(data["daily"], list):
         return False, "'daily' must be an array"
 
-    # Validate daily entries
-    required_entry_fields = [
-        "date",
-        "totalTokens",
-        "totalCost",
-        "inputTokens",
-        "outputTokens",
-    ]
-
-    for idx, entry in enumerate(data["daily"]):
-        for field in required_entry_fields:
-            if field not in entry:
-                return False, f"Missing field '{field}' in daily entry {idx}"
-
-        # Validate date format (YYYY-MM-DD)
-        try:
-            datetime.strptime(entry["date"], "%Y-%m-%d")
-        except ValueError:
-            return False, f"Invalid date format in entry {idx}: {entry['date']}"
+    return True, None
+
+
+def validate_daily_entry(idx, entry):
+    """
+    Validate a single daily entry from ccusage.
+
+    Args:
+        idx: Position of the entry in the 'daily' array
+        entry: Parsed daily entry
+
+    Returns:
+        tuple: (is_valid, error_message)
+    """
+    if not isinstance(entry, dict):
+        return False, f"Daily entry {idx} must be a JSON object"
+
+    for field in REQUIRED_ENTRY_FIELDS:
+        if field not in entry:
+            return False, f"Missing field '{field}' in daily entry {idx}"
+
+    # Validate date format (YYYY-MM-DD): the regex rejects malformed strings
+    # cheaply, date.fromisoformat() then rejects out-of-range days like
+    # 2024-13-40 without strptime's format parsing
+    value = entry["date"]
+    try:
+        if not isinstance(value, str) or not DATE_RE.fullmatch(value):
+            raise ValueError
+        date.fromisoformat(value)
+    except ValueError:
+        return False, f"Invalid date format in entry {idx}: {value}"
+
+    breakdowns = entry.get("modelBreakdowns", [])
+    if not isinstance(breakdowns, list):
+        return False, f"'modelBreakdowns' in daily entry {idx} must be an array"
+    for model_idx, model in enumerate(breakdowns):
+        if not isinstance(model, dict):
+            return (
+                False,
+                f"Model breakdown {model_idx} in daily entry {idx} "
+                "must be a JSON object",
+            )
+        for field in REQUIRED_MODEL_FIELDS:
+            if field not in model:
+                return (
+                    False,
+                    f"Missing field '{field}' in model breakdown {model_idx} "
+                    f"of daily entry {idx}",
+                )
 
     return True, None
 
 
+class RecordingReader:
+    """File wrapper that keeps a copy of every chunk read through it"""
+
+    def __init__(self, f):
+        self.f = f
+        self.chunks = []
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.chunks.append(data)
+        return data
+
+
+class ReplayReader:
+    """File wrapper that returns `head` before reading on from `f`"""
+
+    def __init__(self, head, f):
+        self.head = head
+        self.f = f
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.f.read(size)
+        if size < 0:
+            data, self.head = self.head + self.f.read(), b""
+        else:
+            data, self.head = self.head[:size], self.head[size:]
+        return data
+
+
+def stream_daily_entries(f):
+    """
+    Incrementally parse the 'daily' entries of a ccusage export with ijson.
+
+    Only one entry is held in memory at a time. The parse events up to the
+    start of the 'daily' array are checked first, so the export is accepted
+    or rejected exactly as validate_json_structure() would. The bytes read
+    for that check are then replayed into ijson.items(), whose C backend
+    parses the entries without any per-event Python code.
+    """
+    recorder = RecordingReader(f)
+    events = ijson.parse(recorder)
+    try:
+        for _, event, _ in events:
+            if event != "start_map":
+                raise ValueError("Data must be a JSON object")
+            break
+        for prefix, event, _ in events:
+            if prefix == "daily":
+                if event != "start_array":
+                    raise ValueError("'daily' must be an array")
+                break
+        else:
+            raise ValueError("Missing required field: 'daily'")
+
+        replay = ReplayReader(b"".join(recorder.chunks), f)
+        yield from ijson.items(replay, "daily.item", use_float=True)
+    except ijson.JSONError as e:
+        raise ValueError(e) from e
+
+
+class HashingReader:
+    """File wrapper that feeds every chunk read through a BLAKE2b digest"""
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.blake2b()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        """Digest of the whole input, reading whatever the parser left"""
+        for _ in iter(lambda: self.read(1 << 20), b""):
+            pass
+        return self.digest.hexdigest()
+
+
+def streams_export(from_stdin):
+    """
+    Whether to stream the export with ijson rather than load it in one go.
+
+    Files are loaded with orjson when it is installed, which is the fastest
+    option for exports of any realistic size. Otherwise, and always for
+    stdin, ijson streams the export if available, so memory use stays flat
+    however much history it holds; the json module is the last resort.
+    """
+    return ijson is not None and (from_stdin or orjson is None)
+
+
+def iter_daily_entries(export):
+    """
+    Yield the daily entries of a ccusage export.
+
+    Args:
+        export: The export's bytes, or a binary file to stream it from
+            (see streams_export())
+
+    Entries are validated by row_batches() as they become rows.
+
+    Raises:
+        ValueError: On malformed JSON or an invalid top-level structure
+    """
+    if not isinstance(export, bytes):
+        yield from stream_daily_entries(export)
+        return
+
+    data = orjson.loads(export) if orjson is not None else json.loads(export)
+    is_valid, error_msg = validate_json_structure(data)
+    if not is_valid:
+        raise ValueError(error_msg)
+    yield from data["daily"]
+
+
+def file_digest(path):
+    """Return a BLAKE2b hex digest of a file's contents, read in chunks"""
+    digest = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stored_input_hash(db_path):
+    """
+    Return the input hash recorded by the last replace-mode load, if any.
+
+    The database is opened read-only, so checking it never modifies the
+    file or creates it when it is missing.
+    """
+    if not os.path.exists(db_path):
+        return None
+    uri = Path(db_path).resolve().as_uri() + "?mode=ro"
+    try:
+        conn = sqlite3.connect(uri, uri=True)
+        try:
+            cursor = conn.execute("SELECT v FROM _meta WHERE k = 'input_hash'")
+            row = cursor.fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+
+def open_json(json_file):
+    """Open a ccusage export for parsing; '-' reads from stdin"""
+    # All parsers take bytes, which also skips a text decoding pass
+    if json_file == "-":
+        return nullcontext(sys.stdin.buffer)
+    return open(json_file, "rb")
+
+
+def row_batches(entries, size):
+    """
+    Validate daily entries and build their parameter rows in a single pass.
+
+    Each entry is checked right before its daily_usage and model_usage
+    rows are built from it, so the parsed dicts are only walked once.
+
+    Args:
+        entries: Iterable of daily entries from the export
+        size: Number of days per batch
+
+    Yields:
+        tuple: (daily_rows, model_rows) for up to `size` days, where
+            model_rows[i] is the list of model rows for daily_rows[i]
+
+    Raises:
+        ValueError: On an invalid entry
+    """
+    daily, models = [], []
+    for idx, day in enumerate(entries):
+        is_valid, error_msg = validate_daily_entry(idx, day)
+        if not is_valid:
+            raise ValueError(error_msg)
+
+        # Required fields were just validated as present, so only the
+        # optional ones need a default before itemgetter builds the row in C
+        for key in OPTIONAL_DAILY_FIELDS:
+            day.setdefault(key, 0)
+        daily.append(daily_row(day))
+
+        day_date = day["date"]
+        models.append(
+            [
+                (
+                    day_date,
+                    model["modelName"],
+                    model.get("inputTokens", 0),
+                    model.get("outputTokens", 0),
+                    model.get("cacheCreationTokens", 0),
+                    model.get("cacheReadTokens", 0),
+                    model["cost"],
+                )
+                # () avoids allocating a list for days without a breakdown
+                for model in day.get("modelBreakdowns", ())
+            ]
+        )
+
+        if len(daily) == size:
+            yield daily, models
+            daily, models = [], []
+
+    if daily:
+        yield daily, models
+
+
+def count_rows(cursor):
+    """Return (daily_usage, model_usage) row counts"""
+    cursor.execute(
+        "SELECT (SELECT COUNT(*) FROM daily_usage), (SELECT COUNT(*) FROM model_usage)"
+    )
+    return cursor.fetchone()
+
+
+@lru_cache(maxsize=None)
+def values_sql(sql, width, count):
+    """
+    Expand the {values} placeholder into `count` row groups of `width` params.
+
+    Memoized so every batch reuses the same string object, which is also
+    what the connection's prepared-statement cache is keyed on.
+    """
+    group = "(" + ", ".join(["?"] * width) + ")"
+    return sql.format(values=", ".join([group] * count))
+
+
+def rows_per_insert(cursor, width):
+    """Largest multi-row VALUES batch that fits SQLite's bound-parameter limit"""
+    limit = SQLITE_DEFAULT_MAX_VARIABLES
+    # Connection.getlimit() is only available on Python 3.11+
+    if hasattr(cursor.connection, "getlimit"):
+        limit = cursor.connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    return max(1, min(MAX_ROWS_PER_INSERT, limit // width))
+
+
+def upsert_rows(cursor, sql, rows, describe):
+    """
+    Insert rows using multi-row VALUES statements.
+
+    Rows are sent in chunks, one INSERT per chunk, so SQLite parses and
+    runs one statement per chunk instead of one per row. A statement is
+    atomic, so if a chunk fails it is retried row by row and only the bad
+    rows are skipped.
+
+    Args:
+        cursor: SQLite cursor with an open transaction
+        sql: INSERT statement with a {values} placeholder
+        rows: Iterable of parameter tuples
+        describe: Callable returning a row label for error messages
+
+    Returns:
+        tuple: (rows inserted or updated, set of positions in `rows` of
+            the rows that were rejected)
+    """
+    if not isinstance(rows, list):
+        rows = list(rows)
+    if not rows:
+        return 0, set()
+
+    width = len(rows[0])
+    size = rows_per_insert(cursor, width)
+    chunk_sql = values_sql(sql, width, size)
+    row_sql = values_sql(sql, width, 1)
+
+    # Count rows touched through the connection's running total instead of
+    # reading rowcount after every statement; failed statements add nothing
+    conn = cursor.connection
+    changes_before = conn.total_changes
+    rejected = set()
+    for start in range(0, len(rows), size):
+        chunk = rows[start : start + size]
+        if len(chunk) < size:
+            chunk_sql = values_sql(sql, width, len(chunk))
+        try:
+            # Flatten the chunk in C rather than with a per-value Python loop
+            cursor.execute(chunk_sql, list(chain.from_iterable(chunk)))
+        except sqlite3.Error:
+            errors = []
+            for pos, row in enumerate(chunk, start):
+                try:
+                    cursor.execute(row_sql, row)
+                except sqlite3.Error as e:
+                    rejected.add(pos)
+                    errors.append(f"Error inserting {describe(row)}: {e}")
+            log_errors(errors)
+    return conn.total_changes - changes_before, rejected
+
+
+def drop_models_used_column(cursor):
+    """
+    Drop the models_used column from databases created by older versions.
+
+    The models used per day now come from the daily_models view. ALTER
+    TABLE ... DROP COLUMN needs SQLite 3.35+; on older versions the column
+    is left in place and simply stays NULL for new rows.
+    """
+    cursor.execute("PRAGMA table_info(daily_usage)")
+    if "models_used" not in [row[1] for row in cursor.fetchall()]:
+        return
+    try:
+        cursor.execute("ALTER TABLE daily_usage DROP COLUMN models_used")
+    except sqlite3.OperationalError as e:
+        log_warn(f"Could not drop legacy models_used column: {e}")
+
+
+def apply_load_pragmas(conn, unsafe=False):
+    """
+    Tune the connection for a bulk load.
+
+    WAL with synchronous=NORMAL avoids the rollback journal's double fsync
+    per commit, and a large page cache keeps index pages in memory while
+    rows are inserted. These settings only last for this connection,
+    except journal_mode, which finish_load() resets.
+    """
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={'OFF' if unsafe else 'NORMAL'}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-200000")  # ~200 MiB
+    conn.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+
+
+def finish_load(conn):
+    """
+    Switch back to a rollback journal once the load has committed.
+
+    This checkpoints the WAL into the main file and removes the -wal/-shm
+    files, so the database stays a single self-contained file. Grafana
+    mounts claude_usage.db read-only on its own and cannot see them.
+    """
+    try:
+        conn.execute("PRAGMA journal_mode=DELETE")
+    except sqlite3.OperationalError as e:
+        log_warn(f"Could not switch database out of WAL mode: {e}")
+
+
 def create_database(
     json_file="data/export_latest.json",
     db_path="claude_usage.db",
     mode="replace",
     verbose=False,
+    unsafe=False,
+    force=False,
 ):
     """
     Create/update SQLite database from ccusage JSON data.
 
     Args:
-        json_file: Path to JSON file
+        json_file: Path to JSON file, or '-' to read from stdin
         db_path: Path to SQLite database
         mode: 'replace' to clear existing data, 'append' to add to existing
         verbose: Print detailed information
+        unsafe: Skip fsync entirely (synchronous=OFF) for the fastest load;
+            a crash or power loss mid-load can corrupt the database
+        force: Reload even if the file matches the last replace-mode load
     """
+    source = "stdin" if json_file == "-" else json_file
+
     # Validate JSON file exists
-    if not os.path.exists(json_file):
+    if json_file != "-" and not os.path.exists(json_file):
         log_error(f"JSON file not found: {json_file}")
         log_info("Please run ./refresh_data.sh first to generate data files")
         sys.exit(1)
 
-    # Load and validate JSON data
-    log_info(f"Loading data from {json_file}...")
-    try:
-        with open(json_file, "r") as f:
-            data = json.load(f)
-    except json.JSONDecodeError as e:
-        log_error(f"Invalid JSON in {json_file}: {e}")
-        sys.exit(1)
-
-    # Validate JSON structure
-    is_valid, error_msg = validate_json_structure(data)
-    if not is_valid:
-        log_error(f"Invalid JSON structure: {error_msg}")
-        sys.exit(1)
-
-    log_success(f"JSON validation passed ({len(data['daily'])} records)")
+    # Unless it is streamed, read the export once up front: the same bytes
+    # are hashed and parsed, so the recorded hash always matches the data
+    stream = streams_export(from_stdin=json_file == "-")
+    raw = None
+    if not stream:
+        with open_json(json_file) as f:
+            raw = f.read()
+
+    # Skip the load entirely if a replace-mode run already loaded this exact
+    # file; the hash is only recorded by replace mode, since that is the only
+    # mode that leaves the database holding nothing but the file's contents.
+    # This runs before anything opens the database for writing, so a no-op
+    # run leaves the file Grafana reads untouched.
+    input_hash = None
+    if mode == "replace" and json_file != "-":
+        if raw is not None:
+            input_hash = hashlib.blake2b(raw).hexdigest()
+        else:
+            input_hash = file_digest(json_file)
+        if not force and stored_input_hash(db_path) == input_hash:
+            log_success(f"No changes in {source} since the last load")
+            return
 
     # Create/connect to SQLite database
     log_info(f"Connecting to database: {db_path}...")
+    db_existed = os.path.exists(db_path)
     conn = sqlite3.connect(db_path)
+    # Manage transactions explicitly so the whole load commits exactly once
+    conn.isolation_level = None
+    apply_load_pragmas(conn, unsafe=unsafe)
     cursor = conn.cursor()
 
-    # Create daily usage table
-    cursor.execute(
+    # Load everything in a single transaction: one commit (and one fsync)
+    # instead of one per statement, and replace mode never leaves the tables
+    # half-empty. A failing INSERT only rolls back its own statement, so bad
+    # rows are still skipped; any error that ends the load is rolled back.
+    # SQLite DDL is transactional, so the schema setup and migrations below
+    # are part of it too and invalid input leaves the schema as it was.
+    cursor.execute("BEGIN")
+    try:
+        # Create daily usage table
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS daily_usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                date TEXT NOT NULL UNIQUE,
+                input_tokens INTEGER,
+                output_tokens INTEGER,
+                cache_creation_tokens INTEGER,
+                cache_read_tokens INTEGER,
+                total_tokens INTEGER,
+                total_cost REAL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
         """
-        CREATE TABLE IF NOT EXISTS daily_usage (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT NOT NULL UNIQUE,
-            input_tokens INTEGER,
-            output_tokens INTEGER,
-            cache_creation_tokens INTEGER,
-            cache_read_tokens INTEGER,
-            total_tokens INTEGER,
-            total_cost REAL,
-            models_used TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
-    """
-    )
 
-    # Create model breakdowns table
-    cursor.execute(
+        # Create model breakdowns table
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS model_usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                date TEXT NOT NULL,
+                model_name TEXT NOT NULL,
+                input_tokens INTEGER,
+                output_tokens INTEGER,
+                cache_creation_tokens INTEGER,
+                cache_read_tokens INTEGER,
+                cost REAL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(date, model_name)
+            )
         """
-        CREATE TABLE IF NOT EXISTS model_usage (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT NOT NULL,
-            model_name TEXT NOT NULL,
-            input_tokens INTEGER,
-            output_tokens INTEGER,
-            cache_creation_tokens INTEGER,
-            cache_read_tokens INTEGER,
-            cost REAL,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(date, model_name)
         )
-    """
-    )
 
-    # Clear existing data if in replace mode
-    if mode == "replace":
-        log_info("Clearing existing data (replace mode)...")
-        cursor.execute("DELETE FROM daily_usage")
-        cursor.execute("DELETE FROM model_usage")
-        records_mode = "Replacing"
-    else:
-        records_mode = "Appending"
+        # Models used per day, derived from model_usage rather than stored twice
+        cursor.execute(DAILY_MODELS_VIEW_SQL)
+        drop_models_used_column(cursor)
+        for name in REDUNDANT_INDEXES:
+            cursor.execute(f"DROP INDEX IF EXISTS {name}")
+
+        # Load bookkeeping, such as the hash of the last replace-mode input
+        cursor.execute("CREATE TABLE IF NOT EXISTS _meta (k TEXT PRIMARY KEY, v TEXT)")
+
+        # Clear existing data if in replace mode
+        if mode == "replace":
+            log_info("Clearing existing data (replace mode)...")
+            # Building the secondary indexes once after the load is cheaper than
+            # updating them on every insert. The UNIQUE constraints stay: the
+            # append-mode upserts rely on them.
+            for name, _ in INDEXES:
+                cursor.execute(f"DROP INDEX IF EXISTS {name}")
+            cursor.execute("DELETE FROM daily_usage")
+            cursor.execute("DELETE FROM model_usage")
+            records_mode = "Replacing"
+            daily_sql, model_sql = DAILY_INSERT_SQL, MODEL_INSERT_SQL
+        else:
+            records_mode = "Appending"
+            daily_sql, model_sql = DAILY_UPSERT_SQL, MODEL_UPSERT_SQL
+
+        # Track statistics: the upserts report how many rows they touched and
+        # the row counts before/after tell inserts apart from updates. Replace
+        # mode has just emptied both tables, so there is nothing to count.
+        if mode == "replace":
+            daily_before, model_before = 0, 0
+        else:
+            daily_before, model_before = count_rows(cursor)
+        daily_count = 0
+        daily_changed = 0
+        model_changed = 0
+
+        # Parse, validate and insert the export one batch of days at a time.
+        # Invalid input may only show up mid-load; rolling back the transaction
+        # then leaves the database exactly as it was. Rows go straight into the
+        # real tables: staging them in an attached :memory: database and copying
+        # them over with INSERT ... SELECT inserts every row twice and measured
+        # slower, since this transaction already defers all disk writes to COMMIT.
+        log_info(f"Loading data from {source}...")
+        log_info(f"{records_mode} daily records...")
+        with open_json(json_file) if stream else nullcontext(raw) as export:
+            # A streamed file is hashed as it is parsed, so the recorded
+            # hash is of the bytes loaded even if the file changed since
+            # the check above
+            if stream and input_hash is not None:
+                export = HashingReader(export)
+            entries = iter_daily_entries(export)
+            for days, models in row_batches(entries, DAYS_PER_BATCH):
+                daily_count += len(days)
+
+                # Insert/update daily usage data
+                changed, rejected = upsert_rows(
+                    cursor,
+                    daily_sql,
+                    days,
+                    lambda row: f"daily record for {row[0]}",
+                )
+                daily_changed += changed
+
+                # An entry whose daily record was rejected gets no model
+                # records, so model_usage never holds days missing from
+                # daily_usage. Rejections are by position, not date, so a
+                # repeated date only loses the failed entry's breakdowns.
+                model_rows = list(
+                    chain.from_iterable(
+                        day_models
+                        for pos, day_models in enumerate(models)
+                        if pos not in rejected
+                    )
+                )
+
+                # Insert/update model breakdown data
+                changed, _ = upsert_rows(
+                    cursor,
+                    model_sql,
+                    model_rows,
+                    lambda row: f"model record for {row[0]}, {row[1]}",
+                )
+                model_changed += changed
 
-    log_info(f"{records_mode} {len(data['daily'])} daily records...")
+            if isinstance(export, HashingReader):
+                input_hash = export.hexdigest()
 
-    # Track statistics
-    daily_inserted = 0
-    daily_updated = 0
-    model_inserted = 0
-    model_updated = 0
+        log_success(f"JSON validation passed ({daily_count} records)")
 
-    # Insert/update daily usage data
-    for day in data["daily"]:
-        models_used = ",".join(day.get("modelsUsed", []))
+        # Create useful indexes
+        log_info("Creating indexes...")
+        for _, ddl in INDEXES:
+            cursor.execute(ddl)
 
-        try:
+        # Remember what was loaded, in the same transaction as the data
+        if input_hash is not None:
             cursor.execute(
-                """
-                INSERT INTO daily_usage
-                (date, input_tokens, output_tokens, cache_creation_tokens,
-                 cache_read_tokens, total_tokens, total_cost, models_used)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ON CONFLICT(date) DO UPDATE SET
-                    input_tokens=excluded.input_tokens,
-                    output_tokens=excluded.output_tokens,
-                    cache_creation_tokens=excluded.cache_creation_tokens,
-                    cache_read_tokens=excluded.cache_read_tokens,
-                    total_tokens=excluded.total_tokens,
-                    total_cost=excluded.total_cost,
-                    models_used=excluded.models_used,
-                    updated_at=CURRENT_TIMESTAMP
-            """,
-                (
-                    day["date"],
-                    day.get("inputTokens", 0),
-                    day.get("outputTokens", 0),
-                    day.get("cacheCreationTokens", 0),
-                    day.get("cacheReadTokens", 0),
-                    day["totalTokens"],
-                    day["totalCost"],
-                    models_used,
-                ),
+                "INSERT OR REPLACE INTO _meta (k, v) VALUES ('input_hash', ?)",
+                (input_hash,),
             )
-            if cursor.rowcount == 1:
-                daily_inserted += 1
-            else:
-                daily_updated += 1
-        except sqlite3.Error as e:
-            log_error(f"Error inserting daily record for {day['date']}: {e}")
-            continue
-
-        # Insert/update model breakdown data
-        for model in day.get("modelBreakdowns", []):
-            try:
-                cursor.execute(
-                    """
-                    INSERT INTO model_usage
-                    (date, model_name, input_tokens, output_tokens,
-                     cache_creation_tokens, cache_read_tokens, cost)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                    ON CONFLICT(date, model_name) DO UPDATE SET
-                        input_tokens=excluded.input_tokens,
-                        output_tokens=excluded.output_tokens,
-                        cache_creation_tokens=excluded.cache_creation_tokens,
-                        cache_read_tokens=excluded.cache_read_tokens,
-                        cost=excluded.cost
-                """,
-                    (
-                        day["date"],
-                        model["modelName"],
-                        model.get("inputTokens", 0),
-                        model.get("outputTokens", 0),
-                        model.get("cacheCreationTokens", 0),
-                        model.get("cacheReadTokens", 0),
-                        model["cost"],
-                    ),
-                )
-                if cursor.rowcount == 1:
-                    model_inserted += 1
-                else:
-                    model_updated += 1
-            except sqlite3.Error as e:
-                log_error(
-                    f"Error inserting model record for {day['date']}, "
-                    f"{model['modelName']}: {e}"
-                )
-                continue
+        else:
+            cursor.execute("DELETE FROM _meta WHERE k = 'input_hash'")
 
-    # Create useful indexes
-    log_info("Creating indexes...")
-    cursor.execute(
-        "CREATE INDEX IF NOT EXISTS idx_daily_date ON daily_usage(date DESC)"
-    )
+        # Commit changes
+        cursor.execute("COMMIT")
+    except ValueError as e:
+        log_error(f"Invalid JSON in {source}: {e}")
+        sys.exit(1)
+    finally:
+        # However the load ends early (invalid input, a malformed value,
+        # a locked database), roll it back and switch out of WAL so the
+        # database stays a single file Grafana can read
+        if conn.in_transaction:
+            cursor.execute("ROLLBACK")
+            finish_load(conn)
+            conn.close()
+            # Connecting created an empty database file; don't leave it behind
+            if not db_existed:
+                os.remove(db_path)
+    finish_load(conn)
+
+    # Gather the report: the daily totals are one scan of daily_usage, and
+    # the per-model day counts add up to the model_usage row count
     cursor.execute(
-        "CREATE INDEX IF NOT EXISTS idx_model_date ON model_usage(date DESC)"
+        """
+        SELECT COUNT(*),
+               SUM(cache_creation_tokens) as cache_created,
+               SUM(cache_read_tokens) as cache_read,
+               SUM(total_tokens) as total_tokens
+        FROM daily_usage
+    """
     )
+    total_daily_count, cache_created, cache_read, total_tokens = cursor.fetchone()
+
     cursor.execute(
-        "CREATE INDEX IF NOT EXISTS idx_model_name ON model_usage(model_name)"
+        """
+        SELECT date, total_tokens, total_cost, models_used
+        FROM daily_usage
+        LEFT JOIN daily_models USING (date)
+        ORDER BY date DESC
+        LIMIT 5
+    """
     )
+    recent_days = cursor.fetchall()
+
     cursor.execute(
-        "CREATE INDEX IF NOT EXISTS idx_model_date_name ON model_usage(date, model_name)"
+        """
+        SELECT model_name,
+               COUNT(*) as days,
+               SUM(input_tokens + output_tokens) as total_tokens,
+               SUM(cost) as total_cost
+        FROM model_usage
+        GROUP BY model_name
+        ORDER BY total_cost DESC
+    """
     )
+    model_summary = cursor.fetchall()
+    total_model_count = sum(row[1] for row in model_summary)
 
-    # Commit changes
-    conn.commit()
-
-    # Get final counts
-    cursor.execute("SELECT COUNT(*) FROM daily_usage")
-    total_daily_count = cursor.fetchone()[0]
-
-    cursor.execute("SELECT COUNT(*) FROM model_usage")
-    total_model_count = cursor.fetchone()[0]
+    daily_inserted = total_daily_count - daily_before
+    daily_updated = daily_changed - daily_inserted
+    model_inserted = total_model_count - model_before
+    model_updated = model_changed - model_inserted
 
     # Show results
     print()
@@ -299,15 +864,7 @@ def create_database(
     # Show sample data
     print()
     print("📋 Recent daily usage (last 5 days):")
-    cursor.execute(
-        """
-        SELECT date, total_tokens, total_cost, models_used
-        FROM daily_usage
-        ORDER BY date DESC
-        LIMIT 5
-    """
-    )
-    for row in cursor.fetchall():
+    for row in recent_days:
         print(f"  {row[0]}: {row[1]:,} tokens, ${row[2]:.2f}")
         if row[3] and verbose:
             print(f"    Models: {row[3]}")
@@ -315,39 +872,17 @@ def create_database(
     # Show model summary
     print()
     print("🤖 Model usage summary:")
-    cursor.execute(
-        """
-        SELECT model_name,
-               COUNT(*) as days,
-               SUM(input_tokens + output_tokens) as total_tokens,
-               SUM(cost) as total_cost
-        FROM model_usage
-        GROUP BY model_name
-        ORDER BY total_cost DESC
-    """
-    )
-    for row in cursor.fetchall():
-        model_short = row[0].split("-")[-1] if "-" in row[0] else row[0]
+    for row in model_summary:
         print(f"  {row[0]}")
         print(f"    Days used: {row[1]}, Tokens: {row[2]:,}, Cost: ${row[3]:.2f}")
 
     # Show cache efficiency
     print()
     print("💾 Cache efficiency:")
-    cursor.execute(
-        """
-        SELECT
-            SUM(cache_creation_tokens) as cache_created,
-            SUM(cache_read_tokens) as cache_read,
-            SUM(total_tokens) as total_tokens
-        FROM daily_usage
-    """
-    )
-    row = cursor.fetchone()
-    if row[0] and row[1]:
-        cache_ratio = (row[1] / row[2] * 100) if row[2] > 0 else 0
-        print(f"  Cache created: {row[0]:,} tokens")
-        print(f"  Cache read: {row[1]:,} tokens")
+    if cache_created and cache_read:
+        cache_ratio = (cache_read / total_tokens * 100) if total_tokens > 0 else 0
+        print(f"  Cache created: {cache_created:,} tokens")
+        print(f"  Cache read: {cache_read:,} tokens")
         print(f"  Cache hit rate: {cache_ratio:.1f}%")
 
     conn.close()
@@ -369,7 +904,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--json",
         default="data/export_latest.json",
-        help="Path to JSON file (default: data/export_latest.json)",
+        help="Path to JSON file, or - for stdin (default: data/export_latest.json)",
     )
     parser.add_argument(
         "--db",
@@ -385,9 +920,24 @@ if __name__ == "__main__":
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="Verbose output"
     )
+    parser.add_argument(
+        "--unsafe",
+        action="store_true",
+        help="Disable fsync during the load (faster, but a crash can corrupt the DB)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Reload even if the JSON file is unchanged since the last load",
+    )
 
     args = parser.parse_args()
 
     create_database(
-        json_file=args.json, db_path=args.db, mode=args.mode, verbose=args.verbose
+        json_file=args.json,
+        db_path=args.db,
+        mode=args.mode,
+        verbose=args.verbose,
+        unsafe=args.unsafe,
+        force=args.force,
     )